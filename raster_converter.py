@@ -1,8 +1,19 @@
 """Convert images into circloO objects."""
 
+from itertools import chain
+from typing import NamedTuple, TextIO
+from warnings import warn
+
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
+
+try:
+    from numba import njit, prange
+except ImportError:  # without Numba the dithering kernel runs as plain (slow) Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+    prange = range
 
 
 def convert_image(img_path: str,
@@ -14,8 +25,9 @@ def convert_image(img_path: str,
                   scale: int | float = 1,
                   threshold: int | float = .5,
                   channel_weights: tuple[int, int, int] = (1, 1, 1),
-                  show_img: bool = True
-                  ) -> str:
+                  show_img: bool = True,
+                  file: TextIO | None = None
+                  ) -> str | None:
     """
     Convert an image to gcode for printing.
     :param img_path:            Path of image.
@@ -28,65 +40,201 @@ def convert_image(img_path: str,
     :param threshold:           Threshold to turn a cell on after averaging channels. Default is .5
     :param channel_weights:     Weighting of each channel. Default is (1, 1, 1), equal weighting.
     :param show_img:            Show the final image that will be printed. Default is True.
-    :return:                    String of gcode.
+    :param file:                Open text file to stream the gcode into. Default is None, return it as a string.
+    :return:                    String of gcode, or None if written to file.
     """
 
     # Open Image.
     img = Image.open(f"{img_path}")
 
     # Convert to numpy array.
-    data = np.array(img).astype(np.float32) / 255  # normalize values as floats b/w 0 & 1
+    data = np.asarray(img)
     if len(data.shape) == 2:  # add new channel if B&W image to preserve algorithms
         data = data[:, :, np.newaxis]
 
     # Process Image.
-    data_smaller = downsample(data, downsample_factor)
-    data_adjusted = floyd_steinberg(data_smaller)
+    data_smaller = downsample(data, downsample_factor)  # 8-bit values; dithering copies them to int16 planes
+    if is_near_binary(data_smaller, white=255):
+        # Nothing to diffuse, so snap values to 0 or 1 directly.
+        data_adjusted = data_smaller >= 128
+    else:
+        data_adjusted = floyd_steinberg(data_smaller)
     data_avg = average_array(data_adjusted, channel_weights, threshold)
 
     if show_img:
-        plt.imshow(data_avg, cmap='Grays')
-        plt.show()
+        try:
+            import matplotlib.pyplot as plt  # only needed for the preview, and slow to import
+        except ImportError:
+            warn("matplotlib is not installed, so the image will not be shown.")
+        else:
+            plt.imshow(data_avg, cmap='Grays')
+            plt.show()
 
     match mode:
         case "normal":
-            gcode = to_gcode(data_avg, x, y, z_offset, scale)
+            gcode = to_gcode(data_avg, x, y, z_offset, scale, file)
         case "reduced":
             data_reduced = reduce_by_row(data_avg)
-            gcode = to_gcode_reduced(data_reduced, x, y, z_offset, scale)
+            gcode = to_gcode_reduced(data_reduced, x, y, z_offset, scale, file)
         case _:
             # Default to normal
-            gcode = to_gcode(data_avg, x, y, z_offset, scale)
+            gcode = to_gcode(data_avg, x, y, z_offset, scale, file)
 
     return gcode
 
 
 # IMAGE PROCESSING #####################################################################################################
 
-def floyd_steinberg(image: np.array) -> np.array:
-    """Floyd-Steinberg dithering algorithm, adjusted to give more contrast.
+def floyd_steinberg(image: np.array, wavefront: bool = False) -> np.array:
+    """Floyd-Steinberg dithering algorithm, adjusted to give more contrast. Returns a dithered (0 or 1) copy of image.
+    Works on 8-bit values (0 to 255) in 16-bit integers; float images with values b/w 0 & 1 are scaled to match.
+    Set wavefront to parallelize within each plane (see _fs2d_wavefront()). It is off by default, since it is ~3-4x
+    slower than the serial kernel per thread and is only compiled on first use.
     https://research.cs.wisc.edu/graphics/Courses/559-s2004/docs/floyd-steinberg.pdf"""
-    lx, ly, lc = image.shape
-    for j in range(ly):
+    if np.issubdtype(image.dtype, np.floating):
+        image = np.rint(image * 255)
+    # Channels never exchange error, so dither each one as its own plane, stored (y, x) so rows are contiguous.
+    planes = np.ascontiguousarray(image.transpose(2, 1, 0), dtype=np.int16)
+    if wavefront:
+        for plane in planes:
+            _fs2d_wavefront(plane)
+    elif _fs2d_cython is not None:
+        for plane in planes:
+            _fs2d_cython(plane)
+    else:
+        _fs_planes(planes)
+    return planes.transpose(2, 1, 0)
+
+
+@njit(cache=True)
+def _share(err, weight):
+    """Error passed to a neighbour, err * weight / 24 rounded to the nearest integer (2731 / 2**16 ~= 1 / 24)."""
+    return (err * weight * 2731 + 32768) >> 16
+
+
+@njit(cache=True, boundscheck=False)
+def _fs2d(plane):
+    """Compiled loop for floyd_steinberg(). Dithers a single (y, x) channel plane of 8-bit values in place.
+    Diffused error keeps values within about [-85, 340], which int16 holds with room to spare.
+    Rows are processed in pairs, with row j + 1 trailing row j by one pixel, so the errors row j pushes down into
+    row j + 1 are held in locals instead of being written to the array and read back on the next pass."""
+    # Weights out of 24. Original factors from paper: 7/16, 5/16, 1/16, 3/16
+    w7, w5, w1, w3 = 7, 5, 1, 3
+    ly, lx = plane.shape
+
+    for j in range(0, ly - 1, 2):
+        has_below = j + 2 < ly
+        row0 = plane[j]
+        row1 = plane[j + 1]
+        row2 = plane[min(j + 2, ly - 1)]  # only written to if has_below
+
+        # Errors moving right along each row, and the last three errors of row j (left to right).
+        west0 = 0
+        west1 = 0
+        e_left = 0
+        e_mid = 0
+        for i in range(lx + 1):
+            # Row j, pixel i.
+            e_right = 0
+            if i < lx:
+                v = int(row0[i]) + _share(west0, w7)
+                lit = v >= 128
+                e_right = v - 255 * lit
+                row0[i] = lit
+                west0 = e_right
+
+            # Row j + 1, pixel i - 1.
+            if i > 0:
+                v = int(row1[i - 1]) + _share(e_left, w3) + _share(e_mid, w5) + _share(e_right, w1) + _share(west1, w7)
+                lit = v >= 128
+                err = v - 255 * lit
+                row1[i - 1] = lit
+                west1 = err
+                if has_below:
+                    row2[i - 1] += _share(err, w5)
+                    if i > 1:
+                        row2[i - 2] += _share(err, w1)
+                    if i < lx:
+                        row2[i] += _share(err, w3)
+
+            e_left = e_mid
+            e_mid = e_right
+
+    # Odd row count: the last row has nothing below it.
+    if ly % 2 == 1:
+        row = plane[ly - 1]
+        err = 0
         for i in range(lx):
-            for c in range(lc):
-                rounded = round(image[i, j, c])
-                err = image[i, j, c] - rounded
-                image[i, j, c] = rounded
+            v = int(row[i]) + _share(err, w7)
+            lit = v >= 128
+            err = v - 255 * lit
+            row[i] = lit
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def _fs2d_wavefront(plane):
+    """Parallel version of _fs2d() for a single plane.
+    Pixel (j, i) only depends on (j, i - 1) and on (j - 1, i - 1 .. i + 1), so every pixel on the line i + 2j == k
+    can be quantized at once, sweeping k upwards. Each pixel pulls the errors of its neighbours from a separate
+    buffer instead of pushing its own, so pixels on the same line never write to the same cell."""
+    # Weights out of 24. Original factors from paper: 7/16, 5/16, 1/16, 3/16
+    w7, w5, w1, w3 = 7, 5, 1, 3
+    ly, lx = plane.shape
+    err = np.zeros((ly, lx), dtype=np.int16)
+
+    for k in range(lx + 2 * (ly - 1)):
+        j_first = max(0, (k - lx + 2) // 2)
+        j_last = min(ly - 1, k // 2)
+        for j in prange(j_first, j_last + 1):
+            i = k - 2 * j
+            v = int(plane[j, i])
+            if j > 0:
+                if i > 0:
+                    v += _share(int(err[j - 1, i - 1]), w3)
+                v += _share(int(err[j - 1, i]), w5)
                 if i < lx - 1:
-                    image[i + 1, j, c] += (7 / 24) * err  # Original factor from paper: 7/16
-                if j < ly - 1:
-                    image[i, j + 1, c] += (5 / 24) * err  # Original: 5/16
-                    if i > 0:
-                        image[i - 1, j + 1, c] += (1 / 24) * err  # Original: 1/16
-                    if i < lx - 1:
-                        image[i + 1, j + 1, c] += (3 / 24) * err  # Original: 3/16
-    return image
+                    v += _share(int(err[j - 1, i + 1]), w1)
+            if i > 0:
+                v += _share(int(err[j, i - 1]), w7)
+            lit = v >= 128
+            err[j, i] = v - 255 * lit
+            plane[j, i] = lit
+
+
+@njit(parallel=True, cache=True)
+def _fs_planes(planes):
+    """Dither each (y, x) plane of a (channel, y, x) array in place. Planes are independent, so they run in parallel."""
+    for c in prange(planes.shape[0]):
+        _fs2d(planes[c])
+
+
+try:
+    from _fs import fs2d as _fs2d_cython  # Cython build of the kernel, if compiled (see setup.py)
+except ImportError:
+    _fs2d_cython = None
+    _fs_planes(np.zeros((1, 2, 2), dtype=np.int16))  # warm up the JIT at import
+
+
+def is_near_binary(image: np.array, tolerance=.01, max_fraction=.01, max_samples=10_000, white=1) -> bool:
+    """
+    Check whether an image (e.g. a logo or line art) is already close enough to black & white that dithering is unneeded.
+    :param image:           Image with values b/w 0 & white.
+    :param tolerance:       Distance from 0 or white for a value to still count as binary, as a fraction of white.
+                            Default is .01
+    :param max_fraction:    Largest fraction of non-binary values allowed. Default is .01
+    :param max_samples:     Approximate number of pixels to inspect, taken on an evenly spaced grid. Default is 10,000.
+    :param white:           Value of a white pixel, e.g. 255 for 8-bit images. Default is 1.
+    :return:                True if the image is near-binary.
+    """
+    stride = max(1, int(np.sqrt(image.shape[0] * image.shape[1] / max_samples)))
+    sample = image[::stride, ::stride]
+    grey = np.count_nonzero((sample > tolerance * white) & (sample < (1 - tolerance) * white))
+    return grey <= max_fraction * sample.size
 
 
 def downsample(image: np.array, factor: int) -> np.array:
-    """Reduce image size by factor."""
-    return image.copy()[::factor, ::factor, :]
+    """Reduce image size by factor. Returns a view of image, so copy it before modifying in place."""
+    return image[::factor, ::factor, :]
 
 
 def average_array(arr: np.array, weights=(1, 1, 1), threshold=.5) -> np.array:
@@ -95,40 +243,44 @@ def average_array(arr: np.array, weights=(1, 1, 1), threshold=.5) -> np.array:
     :param arr:         Three-channel binary array.
     :param weights:     Weighting of each channel. Default is (1, 1, 1), equal weighting.
     :param threshold:   Threshold to turn a cell on after averaging. Default is .5
-    :return:            Single-channel binary array.
+    :return:            Single-channel binary array, as booleans.
     """
-    avg = np.dot(arr[:, :, :3], weights) / sum(weights)
-    binary_image = (avg <= threshold).astype(np.float32)
-    return binary_image
+    weights = np.asarray(weights, dtype=np.float32)
+
+    # Compare the weighted sum against the scaled threshold rather than dividing every cell by the weight total.
+    weighted_sum = np.einsum('ijc,c->ij', arr[:, :, :3], weights, optimize=True)
+    return np.less_equal(weighted_sum, threshold * weights.sum())
 
 
-def reduce_by_row(arr: np.array) -> np.array:
+class Runs(NamedTuple):
+    """Runs of consecutive 1's in a binary array, sorted by row then column. Obtained from reduce_by_row()."""
+    rows: np.array      # Row of each run.
+    cols: np.array      # Column where each run starts.
+    lengths: np.array   # Number of cells in each run.
+    shape: tuple        # Shape of the original array.
+
+
+def reduce_by_row(arr: np.array) -> Runs:
     """
-    Reduce binary array for faster printing. Reduced form contains the number of consecutive 1's in the original array.
+    Reduce binary array for faster printing. Reduced form lists each run of consecutive 1's in the original array, so
+    empty cells take no space and are never visited when printing.
     :param arr: Binary array to be reduced.
-    :return:    Reduced Binary Array.
+    :return:    Runs, with int32 rows, starting columns and lengths.
     """
-    new_arr = arr.copy()
-    for i in range(new_arr.shape[0]):
-        point = None
-
-        for j in range(new_arr.shape[1]):
-            cur = new_arr[i, j]
+    on = np.pad(arr == 1, ((0, 0), (1, 1))).astype(np.int8)
+    edges = np.diff(on, axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)  # runs never overlap, so ends pair up with starts in order
 
-            if cur == 1:
-                if point is None:
-                    point = (i, j)
-                else:
-                    new_arr[point] += 1
-                    new_arr[i, j] = 0
-            else:
-                point = None
-    return new_arr
+    return Runs(start_rows.astype(np.int32),
+                start_cols.astype(np.int32),
+                (end_cols - start_cols).astype(np.int32),
+                arr.shape)
 
 
 # GCODE ################################################################################################################
 
-def to_gcode(arr: np.array, x=0, y=0, z_offset=.1, scale=1) -> str:
+def to_gcode(arr: np.array, x=0, y=0, z_offset=.1, scale=1, file: TextIO | None = None) -> str | None:
     """
     Convert binary array into gcode.
     :param arr:         Binary array to be reduced.
@@ -136,7 +288,8 @@ def to_gcode(arr: np.array, x=0, y=0, z_offset=.1, scale=1) -> str:
     :param y:           Initial y position. Default is 0.
     :param z_offset:    Drawing height. Default is .1
     :param scale:       Size of each pixel in mm. Default is 1 mm.
-    :return:            String of gcode.
+    :param file:        Open text file to stream the gcode into. Default is None, return it as a string.
+    :return:            String of gcode, or None if written to file.
     """
     header = ("G28 ; Home all axes\n"
               "G90 ; Use absolute positioning\n"
@@ -154,33 +307,35 @@ def to_gcode(arr: np.array, x=0, y=0, z_offset=.1, scale=1) -> str:
                f"G1 X{x} Y{y} F1000\n")
                # f"M25\n\n")
 
-    lines = [header, outline, "; Start printing\n"]
+    # Only lit pixels are visited; np.nonzero returns them sorted by row. Cells are 0 or 1, so no comparison is needed.
+    ii, jj = np.nonzero(arr)
+    row_ends = np.cumsum(np.bincount(ii, minlength=arr.shape[0])).tolist()
 
-    for i in range(arr.shape[0]):
+    # Each coordinate is formatted once: X into a %-template per row, Y into a lookup table indexed per move.
+    lower = f"G1 Z{z_offset} F600\n"
+    row_templates = [f"G1 X{row_x} Y%s F1500\n{lower}G1 Z2 F600\n"
+                     for row_x in _coordinate_strings(x, arr.shape[0], scale)]
+    ys = _coordinate_strings(y, arr.shape[1], scale)[jj].tolist()
 
-        lines.append(f"; Row {i}")
-        for j in range(arr.shape[1]):
+    rows = _gcode_rows(row_ends, row_templates, ys)
+    chunks = chain([header, outline, "; Start printing\n"], rows, ["M84 ; Disable motors"])
 
-            if arr[i, j] == 1:
-                lines.append(f"G1 X{i * scale + x} Y{j * scale + y} F1500\n"
-                             f"G1 Z{z_offset} F600\n"
-                             f"G1 Z2 F600\n")
+    return _join_or_write(chunks, file)
 
-    lines.append("M84 ; Disable motors")
 
-    return '\n'.join(lines)
-
-
-def to_gcode_reduced(arr: np.array, x=0, y=0, z_offset=.1, scale=1) -> str:
+def to_gcode_reduced(runs: Runs, x=0, y=0, z_offset=.1, scale=1, file: TextIO | None = None) -> str | None:
     """
     Convert reduced binary array (obtained from reduce_by_row() function) into gcode.
-    :param arr:         Reduced Binary Array.
+    :param runs:        Reduced Binary Array, as Runs.
     :param x:           Initial x position. Default is 0.
     :param y:           Initial y position. Default is 0.
     :param z_offset:    Drawing height. Default is .1
     :param scale:       Size of each pixel in mm. Default is 1 mm.
-    :return:            String of gcode.
+    :param file:        Open text file to stream the gcode into. Default is None, return it as a string.
+    :return:            String of gcode, or None if written to file.
     """
+    n_rows, n_cols = runs.shape
+
     header = ("G28 ; Home all axes\n"
               "G90 ; Use absolute positioning\n"
               "G21 ; Set units to millimeters\n"
@@ -191,29 +346,62 @@ def to_gcode_reduced(arr: np.array, x=0, y=0, z_offset=.1, scale=1) -> str:
 
     outline = (f"; Trace outline\n"
                f"G1 X{x} Y{y} F1000\n"
-               f"G1 X{x + len(arr) * scale} Y{y} F1000\n"
-               f"G1 X{x + len(arr) * scale} Y{y + len(arr[0]) * scale} F1000\n"
-               f"G1 X{x} Y{y + len(arr[0]) * scale} F1000\n"
+               f"G1 X{x + n_rows * scale} Y{y} F1000\n"
+               f"G1 X{x + n_rows * scale} Y{y + n_cols * scale} F1000\n"
+               f"G1 X{x} Y{y + n_cols * scale} F1000\n"
                f"G1 X{x} Y{y} F1000\n")
     # f"M25\n\n")
 
-    lines = [header, outline, "; Start printing\n"]
+    row_ends = np.cumsum(np.bincount(runs.rows, minlength=n_rows)).tolist()
+
+    # Each coordinate is formatted once: X into a %-template per row, Y into a lookup table indexed per move.
+    lower = f"G1 Z{z_offset} F600\n"
+    row_templates = [f"G1 X{row_x} Y%s F1500\n{lower}G1 X{row_x} Y%s F1500\nG1 Z2 F600\n"
+                     for row_x in _coordinate_strings(x, n_rows, scale)]
+    y_strings = _coordinate_strings(y, n_cols, scale)
+    ys = y_strings[runs.cols].tolist()
+    ys_end = y_strings[runs.cols + runs.lengths - 1].tolist()
+
+    rows = _gcode_rows(row_ends, row_templates, ys, ys_end)
+    chunks = chain([header, outline, "; Start printing\n"], rows, ["M84 ; Disable motors"])
 
-    for i in range(arr.shape[0]):
+    return _join_or_write(chunks, file)
 
-        lines.append(f"; Row {i}")
-        for j in range(arr.shape[1]):
-            factor = arr[i, j]
 
-            if factor > 0:
-                lines.append(f"G1 X{i * scale + x} Y{j * scale + y} F1500\n"
-                             f"G1 Z{z_offset} F600\n"
-                             f"G1 X{i * scale + x} Y{(j + factor - 1) * scale + y} F1500\n"
-                             f"G1 Z2 F600\n")
+def _coordinate_strings(start, count: int, scale) -> np.array:
+    """
+    Format the position of every pixel along one axis.
+    :param start:   Position of the first pixel.
+    :param count:   Number of pixels.
+    :param scale:   Size of each pixel in mm.
+    :return:        Object array of strings, for fancy indexing by pixel index.
+    """
+    return np.array([str(pos) for pos in (np.arange(count) * scale + start).tolist()], dtype=object)
+
+
+def _gcode_rows(row_ends: list, row_templates: list, *coords: list):
+    """
+    Yield the gcode of each row, one string per row.
+    :param row_ends:        Cumulative number of moves at the end of each row.
+    :param row_templates:   %-format string for a single move in each row, taking one string per list in coords.
+    :param coords:          Lists of preformatted template arguments, one entry per move, sorted by row.
+    """
+    start = 0
+    for i, (end, template) in enumerate(zip(row_ends, row_templates)):
+        moves = zip(*(c[start:end] for c in coords))
+        yield '\n'.join([f"; Row {i}", *map(template.__mod__, moves)])
+        start = end
+
 
-    lines.append("M84 ; Disable motors")
+def _join_or_write(chunks, file: TextIO | None) -> str | None:
+    """Join gcode chunks with newlines into a string, or write them to file one at a time if a file is given."""
+    if file is None:
+        return '\n'.join(chunks)
 
-    return '\n'.join(lines)
+    file.write(next(chunks))
+    for chunk in chunks:
+        file.write('\n')
+        file.write(chunk)
 
 
 def to_file(text: str, path: str) -> None:
@@ -230,8 +418,8 @@ def to_file(text: str, path: str) -> None:
 # EXAMPLE ##############################################################################################################
 
 def main():
-    text = convert_image("mona_lisa.webp", 50, 100, "reduced", 1, .1, 1)
-    to_file(text, "print_mona_lisa.gcode")
+    with open("print_mona_lisa.gcode", 'w') as f:
+        convert_image("mona_lisa.webp", 50, 100, "reduced", 1, .1, 1, file=f)
 
 
 if __name__ == "__main__":
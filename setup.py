@@ -0,0 +1,6 @@
+"""Optional build of the Cython Floyd-Steinberg kernel: python setup.py build_ext --inplace"""
+
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(ext_modules=cythonize("_fs.pyx"))
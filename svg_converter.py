@@ -1,5 +1,6 @@
 from warnings import warn
-from svgpathtools import svg2paths2, parse_path, path as path_pkg
+from io import StringIO
+from svgpathtools import svg2paths2, path as path_pkg
 import cmath
 import math
 import numpy as np
@@ -30,23 +31,34 @@ def append_line(file, start, end):
                     f"G1 X{ex} Y{ey} F1500\n\n")
 
 
-def append_curve(file, curve: path_pkg.Arc | path_pkg.CubicBezier | path_pkg.QuadraticBezier):
-    # distance = math.ceil(cmath.sqrt((curve.end - curve.start)**2).real * 10)  # alternative to const CURVE_RESOLUTION
+def sample_curve(curve: path_pkg.Arc | path_pkg.CubicBezier | path_pkg.QuadraticBezier, n: int) -> np.ndarray:
+    # Evaluate Beziers for all t at once, using the same polynomial forms as curve.point(t).
+    t = np.linspace(0, 1, n)
 
-    movements = []
+    if isinstance(curve, path_pkg.CubicBezier):
+        p0, p1, p2, p3 = curve.start, curve.control1, curve.control2, curve.end
+        return p0 + t * (3 * (p1 - p0) + t * (3 * (p0 + p2) - 6 * p1 + t * (-p0 + 3 * (p1 - p2) + p3)))
 
-    points = [curve.point(t) for t in np.linspace(0, 1, CURVE_RESOLUTION)]
+    if isinstance(curve, path_pkg.QuadraticBezier):
+        tc = 1 - t
+        return tc * tc * curve.start + 2 * tc * t * curve.control + t * t * curve.end
 
-    movements.append(f"; {str(type(curve))[26:-2]}\n"
-                     f"G1 X{width - points[0].real + x} Y{points[0].imag + y} F1500\n"
-                     f"G1 Z{z_offset} F600")
+    # Arcs have no polynomial form.
+    return np.array([curve.point(ti) for ti in t])
 
-    for point in points[1:]:
-        movements.append(f"G1 X{width - point.real + x} Y{point.imag + y}")
 
-    movements.append(f"\n")
+def append_curve(file, curve: path_pkg.Arc | path_pkg.CubicBezier | path_pkg.QuadraticBezier):
+    # distance = math.ceil(cmath.sqrt((curve.end - curve.start)**2).real * 10)  # alternative to const CURVE_RESOLUTION
 
-    file.writelines('\n'.join(movements))
+    points = sample_curve(curve, CURVE_RESOLUTION)
+    xs = (width - points.real + x).tolist()
+    ys = (points.imag + y).tolist()
+
+    file.writelines(f"; {str(type(curve))[26:-2]}\n"
+                    f"G1 X{xs[0]} Y{ys[0]} F1500\n"
+                    f"G1 Z{z_offset} F600\n"
+                    + '\n'.join(map("G1 X{} Y{}".format, xs[1:], ys[1:]))
+                    + "\n\n")
 
 
 # Most common 3D printers only support straight lines, handled in append_curve().
@@ -121,26 +133,27 @@ with open(output_file, 'w') as output_file:
 
     for path in paths:
 
-        output_file.writelines(f"; Start of Path\n\n")
+        # Collect the whole path in memory and write it to the file in one call.
+        path_buffer = StringIO()
+        path_buffer.writelines(f"; Start of Path\n\n")
 
-        parsed_path = parse_path(path.d())
-        for el in parsed_path:
+        for el in path:  # already parsed by svg2paths2()
 
             if isinstance(el, path_pkg.Line):
-                append_line(output_file, el.start, el.end)
+                append_line(path_buffer, el.start, el.end)
 
             elif isinstance(el, path_pkg.CubicBezier):
-                append_curve(output_file, el)
+                append_curve(path_buffer, el)
 
             elif isinstance(el, path_pkg.Arc):
-                append_curve(output_file, el)
+                append_curve(path_buffer, el)
 
             elif isinstance(el, path_pkg.QuadraticBezier):
-                append_curve(output_file, el)
+                append_curve(path_buffer, el)
 
             else:
                 warn(f"Paths of type {type(el)} are not currently supported by this program. "
                      "Any paths of this type will be skipped.")
 
-        output_file.writelines(f"G1 Z{2} F600\n\n\n")
-
+        path_buffer.writelines(f"G1 Z{2} F600\n\n\n")
+        output_file.write(path_buffer.getvalue())